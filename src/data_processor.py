@@ -238,8 +238,17 @@ def _truncate_seq_pair(tokens_a, tokens_b, max_length):
         else:
             tokens_b.pop()
 
+def _batch_encode(examples, max_seq_length, tokenizer):
+    """Tokenizes the text of all examples in a single call of a fast (Rust) tokenizer.
+    Truncation and padding follow the per-example path below: longest sequence first, zero-padded to max_seq_length.
+    The ids come back as [num_examples, max_seq_length] NumPy arrays, so each feature only holds a row view of them"""
+    texts_a = [example.text_a for example in examples]
+    texts_b = [example.text_b for example in examples] if any(example.text_b for example in examples) else None
+    return tokenizer(texts_a, texts_b, padding="max_length", truncation="longest_first", max_length=max_seq_length, return_tensors="np")
+
 def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, Features, maxLenDict):
-    """Loads a data file into a list of `InputBatch`s."""
+    """Loads a data file into a list of `InputBatch`s.
+    With a fast tokenizer (e.g. transformers' BertTokenizerFast) the texts are tokenized in one batch beforehand"""
 
     if Features is not None:
         """Load the mapping dictionaries for additional features, to be used later to convert to ids"""
@@ -259,11 +268,26 @@ def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer
     for (i, label) in enumerate(label_list):
         label_map[label] = i
 
+    encodings = None
+    if "clinical_text" in Features and getattr(tokenizer, "is_fast", False):
+        encodings = _batch_encode(examples, max_seq_length, tokenizer)
+
     features = []
     for (ex_index, example) in enumerate(examples):
         feature = dict()
         
-        if "clinical_text" in Features:
+        if encodings is not None:
+            feature["input_ids"]=encodings["input_ids"][ex_index]
+            feature["input_mask"]=encodings["attention_mask"][ex_index]
+            feature["segment_ids"]=encodings["token_type_ids"][ex_index]
+
+            if ex_index < 2:
+                logger.info("*** Example ***")
+                logger.info("guid: %s" % (example.guid))
+                logger.info("tokens: %s" % " ".join(tokenizer.convert_ids_to_tokens(feature["input_ids"].tolist())))
+                logger.info("input_ids: %s" % " ".join([str(x) for x in feature["input_ids"]]))
+
+        elif "clinical_text" in Features:
             tokens_a = tokenizer.tokenize(example.text_a)
 
             tokens_b = None
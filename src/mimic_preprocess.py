@@ -6,6 +6,10 @@ import csv
 import sys
 import matplotlib.pyplot as plt
 import json
+from functools import lru_cache
+import multiprocessing
+import pyarrow as pa
+import pyarrow.csv as pacsv
 
 
 
@@ -35,9 +39,7 @@ def featureToIdx(features):
     feature2idx["0"] = 0 #will be used to mask padding "codes" in the model
     idx=1
     for entry in features:
-        if entry in feature2idx.keys():
-            pass
-        else:# print(idx, entry)
+        if entry not in feature2idx:
             feature2idx[entry] = idx
             idx+=1
     return feature2idx
@@ -58,6 +60,30 @@ def getICDlevel1(icd9_code):
             return icd9_code[:5]
 
 
+def getICDlevel1Vectorized(icd9_codes):
+    """
+    Column-wise version of getICDlevel1, extracting the first level of hierarchy of every ICD code in a pandas Series at once.
+    """
+    # Built as object arrays so that codes that are neither P_ nor D_ get None, as in getICDlevel1, instead of the
+    # NaN a pandas string column would hold
+    level1 = np.select([icd9_codes.str.startswith("P").to_numpy(dtype=bool), icd9_codes.str.startswith("D_E").to_numpy(dtype=bool),
+                        icd9_codes.str.startswith("D").to_numpy(dtype=bool)],
+                       [icd9_codes.str.slice(0,4).to_numpy(dtype=object), icd9_codes.str.slice(0,6).to_numpy(dtype=object),
+                        icd9_codes.str.slice(0,5).to_numpy(dtype=object)],
+                       default=None)
+    return pd.Series(level1, index=icd9_codes.index, dtype=object)
+
+
+@lru_cache(maxsize=None)
+def loadJSON(filepath):
+    """
+    Loads a JSON mapping file only once, since map_ICD9_to_CCS is called for both diagnoses and procedures.
+    The returned dictionaries are shared between calls and must not be modified.
+    """
+    with open(filepath, 'r') as file:
+        return json.load(file)
+
+
 def writeToJSON(content, filepath):
     if os.path.isfile(filepath):
         with open(filepath, 'r') as file:
@@ -125,35 +151,21 @@ def countCodesPerType(Icd9CcsMap):
 #     return mappedCCSList
 
 def map_ICD9_to_CCS(pandasDataFrame):
-    with open('../data/extended/ICDandCCSmappings/merged_icdccs_codes.json','r') as file:
-        icd9TOCCS_Map = json.load(file)
-    mappedSmallICDList = []
-    mappedCCSList = []
-    unmapped=0
-    mapped=0  
-    for row in pandasDataFrame.itertuples():
-        tempSmallICDCodeList = []
-        tempCCSCodeList = []
-        for ICD9 in row.ICD9_CODE:
-            smallICD = getICDlevel1(ICD9)
-            if smallICD not in tempSmallICDCodeList: tempSmallICDCodeList.append(smallICD)
-            try:
-                CCS_code = icd9TOCCS_Map[ICD9]
-                tempCCSCodeList.append(CCS_code)
-                mapped+=1
-            except KeyError:
-    ## This was previously added but we decided to simply not introduce more noise if the map is unsuccessful
-                # tempCCSCodeList.append("0") #Used for NaN entries
-                unmapped+=1
-        mappedSmallICDList.append(tempSmallICDCodeList)
-        mappedCCSList.append(tempCCSCodeList)
-    with open('../data/extended/ICDandCCSmappings/merged_icd_text.json','r') as file:
-        icd9map = json.load(file)
+    icd9TOCCS_Map = loadJSON('../data/extended/ICDandCCSmappings/merged_icdccs_codes.json')
+    # One row per (admission, code) pair, indexed by the admission row, so the lookups below are done column-wise
+    codes = pandasDataFrame['ICD9_CODE'].explode().dropna()
+    ccs = codes.map(icd9TOCCS_Map)
+    mapped = int(ccs.notna().sum())
+    unmapped = len(ccs) - mapped
+    ## Unmapped codes were previously added as "0" but we decided to simply not introduce more noise if the map is unsuccessful
+    ccsByRow = ccs.dropna().groupby(level=0).agg(list)
+    smallICDByRow = getICDlevel1Vectorized(codes).groupby(level=0).agg(lambda x: list(dict.fromkeys(x)))
+    mappedCCSList = [ccsByRow.get(index, []) for index in pandasDataFrame.index]
+    mappedSmallICDList = [smallICDByRow.get(index, []) for index in pandasDataFrame.index]
+    icd9map = loadJSON('../data/extended/ICDandCCSmappings/merged_icd_text.json')
 
     if not os.path.isfile("../data/extended/smallIcd9ToIdx.json"):
-        smallICDset = set()
-        for code in icd9map.keys():
-            smallICDset.add(getICDlevel1(code))
+        smallICDset = set(getICDlevel1Vectorized(pd.Series(list(icd9map.keys()))))
         smallIcd9ToIdx = featureToIdx(smallICDset)
         writeToJSON(smallIcd9ToIdx, "../data/extended/smallIcd9ToIdx.json")
 
@@ -175,41 +187,34 @@ def map_ICD9_to_CCS(pandasDataFrame):
 
 
 def get_unique_ordered_medication(pandasDataFrame):
-    with open("../data/extended/NDCmappings/ndc_cui_map.json", "r") as file:
-        ndcCuiMap = json.load(file)
+    ndcCuiMap = loadJSON("../data/extended/NDCmappings/ndc_cui_map.json")
     RxNormNdcs = set(ndcCuiMap.keys())
-    mapped=0
-    unmapped=0
+    # Membership is tested on the integer codes to avoid formatting every entry as a string. As with str(int(value)),
+    # the codes written with leading zeros can never be matched, so they are left out
+    RxNormNdcInts = np.fromiter((int(ndc) for ndc in RxNormNdcs if not ndc.startswith("0")), dtype=np.int64)
     if "NDC" in pandasDataFrame.columns.values:
         column = "NDC"
     elif "DRUG" in pandasDataFrame.columns.values:
         column = "DRUG"
-    # counter = 0
-    unique_cuis_list = []
-    for index in pandasDataFrame.index:
-        used_medications = set()
-        #unique_medication = [x for x in pandasDataFrame.loc[index, column] if x not in used_medications and (used_medications.add(x) or True)]
-        unique_medication = []
-        temp_cuis_list = []
-        for value in pandasDataFrame.loc[index, column]:
-            if value not in used_medications and (used_medications.add(value) or True):
-                if pd.isna(value) or value==0.0 or str(int(value)) not in RxNormNdcs: #Attention, the last clause leads to codes not appearing in the set
-                    # if (not pd.isna(value) and not value==0.0):
-                    #     print(value)
-                    #     counter+=1
-                    value = 0 # Swapping NaNs to a default numerical number that is not used elsewhere
-                if value is not 0: unique_medication.append(str(int(value)))
-            if (int(value) is not 0) and (str(int(value)) in RxNormNdcs):
-                mapped+=1
-            else:
-                unmapped+=1
-            try:
-                cui = ndcCuiMap[str(int(value))]
-                if cui not in temp_cuis_list: temp_cuis_list.append(cui)
-            except KeyError:
-                pass
-        unique_cuis_list.append(temp_cuis_list)
-        pandasDataFrame.at[index, column] = unique_medication
+    # One row per (admission, medication) pair, indexed by the admission row. Empty lists are left out, since explode
+    # would turn them into a NaN entry
+    medications = pandasDataFrame[column]
+    medications = medications[medications.map(len) > 0].explode()
+    # NaNs and 0.0 entries are dropped, as well as codes that are not in the RxNorm set
+    valid = medications.notna() & (medications != 0.0)
+    codes = medications.where(valid, 0).astype('int64')
+    known = (valid & codes.isin(RxNormNdcInts)).to_numpy()
+    ndcs = codes[known].astype(str) #Attention, this clause leads to codes not appearing in the set
+    mapped = len(ndcs)
+    unmapped = len(medications) - mapped
+    ndcsByRow = ndcs.groupby(level=0).agg(lambda x: list(dict.fromkeys(x)))
+    # For the CUIs the dropped entries are swapped to the default code "0" instead, which ndcCuiMap maps to the "0" CUI
+    ndcKeys = np.full(len(medications), "0", dtype=object)
+    ndcKeys[known] = ndcs.to_numpy()
+    cuis = pd.Series(ndcKeys, index=medications.index).map(ndcCuiMap).dropna()
+    cuisByRow = cuis.groupby(level=0).agg(lambda x: list(dict.fromkeys(x)))
+    pandasDataFrame[column] = [ndcsByRow.get(index, []) for index in pandasDataFrame.index]
+    unique_cuis_list = [cuisByRow.get(index, []) for index in pandasDataFrame.index]
     ndcsToIdx = featureToIdx(RxNormNdcs)
     cuisToIdx = featureToIdx(set(ndcCuiMap.values()))
     if not os.path.isfile("../data/extended/NDCToIdx.json"): writeToJSON(ndcsToIdx, "../data/extended/NDCToIdx.json")
@@ -219,19 +224,47 @@ def get_unique_ordered_medication(pandasDataFrame):
     return pandasDataFrame, unique_cuis_list
 
 
-
-df_adm = pd.read_csv('/backup/mimiciii/ADMISSIONS.csv.gz', compression="gzip")
+def loadMimicTable(tableName, rowFilter=None, **readCsvArgs):
+    """
+    Loads a MIMIC-III table. The gzipped CSV is only parsed on the first run, after which the table is cached
+    as a Parquet file that the following runs read directly. The cache has to be deleted if the read_csv arguments change.
+    @param rowFilter is an optional (column, values) pair to only keep the rows whose column is in values.
+    When reading the Parquet cache the filter is passed to pyarrow, which drops the other rows while reading (it only
+    skips whole row groups when their min/max statistics exclude the values, so most of the file is still decoded).
+    """
+    cacheFile = os.path.join("/backup/mimiciii/cache", tableName + ".parquet")
+    if os.path.isfile(cacheFile):
+        filters = [(rowFilter[0], "in", list(rowFilter[1]))] if rowFilter is not None else None
+        table = pd.read_parquet(cacheFile, filters=filters)
+    else:
+        table = pd.read_csv(os.path.join("/backup/mimiciii", tableName + ".csv.gz"), compression="gzip", **readCsvArgs)
+        # A column that read_csv parsed partly as numbers and partly as text cannot be written to Parquet, so the
+        # values of the text columns are stored as str (str(4019) == "4019", so the "D_"/"P_" codes do not change)
+        for column in table.columns[table.dtypes == object]:
+            table[column] = table[column].map(str, na_action="ignore")
+        os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+        table.to_parquet(cacheFile, compression="snappy")
+        if rowFilter is not None:
+            table = table[table[rowFilter[0]].isin(rowFilter[1])]
+    # The identifiers fit in 32 bits, which halves the width of the merge and groupby keys. Every table gets the same
+    # int32 type so that the merges do not upcast them back to int64 (columns with missing values are left as they are)
+    idColumns = [column for column in ("SUBJECT_ID", "HADM_ID", "SEQ_NUM") if column in table.columns and table[column].notna().all()]
+    return table.astype({column: np.int32 for column in idColumns})
+
+
+df_adm = loadMimicTable("ADMISSIONS", parse_dates=['ADMITTIME','DISCHTIME','DEATHTIME'])
 df_adm.ADMITTIME = pd.to_datetime(df_adm.ADMITTIME, format = '%Y-%m-%d %H:%M:%S', errors = 'coerce')
 df_adm.DISCHTIME = pd.to_datetime(df_adm.DISCHTIME, format = '%Y-%m-%d %H:%M:%S', errors = 'coerce')
 df_adm.DEATHTIME = pd.to_datetime(df_adm.DEATHTIME, format = '%Y-%m-%d %H:%M:%S', errors = 'coerce')
+# Low cardinality text columns are stored as categoricals (one small integer code per row)
+df_adm['ADMISSION_TYPE'] = df_adm['ADMISSION_TYPE'].astype('category')
 
 df_adm = df_adm.sort_values(['SUBJECT_ID','ADMITTIME'])
 df_adm = df_adm.reset_index(drop = True)
-df_adm['NEXT_ADMITTIME'] = df_adm.groupby('SUBJECT_ID').ADMITTIME.shift(-1)
-df_adm['NEXT_ADMISSION_TYPE'] = df_adm.groupby('SUBJECT_ID').ADMISSION_TYPE.shift(-1)
+subject_groups = df_adm.groupby('SUBJECT_ID')
+df_adm[['NEXT_ADMITTIME','NEXT_ADMISSION_TYPE']] = subject_groups[['ADMITTIME','ADMISSION_TYPE']].shift(-1)
 
-df_adm['PREV_DISCHTIME'] = df_adm.groupby('SUBJECT_ID').DISCHTIME.shift(1)
-df_adm['PREV_ADMISSION_TYPE'] = df_adm.groupby('SUBJECT_ID').ADMISSION_TYPE.shift(1)
+df_adm[['PREV_DISCHTIME','PREV_ADMISSION_TYPE']] = subject_groups[['DISCHTIME','ADMISSION_TYPE']].shift(1)
 
 rows = df_adm.NEXT_ADMISSION_TYPE == 'ELECTIVE'
 df_adm.loc[rows,'NEXT_ADMITTIME'] = pd.NaT
@@ -251,16 +284,15 @@ df_adm['DAYS_PREV_ADMIT'] = (df_adm.ADMITTIME - df_adm.PREV_DISCHTIME).dt.total_
 
 df_adm['OUTPUT_LABEL'] = (df_adm.DAYS_NEXT_ADMIT < 30).astype('int')
 ### filter out newborn and death
-df_adm = df_adm[df_adm['ADMISSION_TYPE']!='NEWBORN']
-df_adm = df_adm[df_adm.DEATHTIME.isnull()]
+df_adm = df_adm.loc[(df_adm['ADMISSION_TYPE']!='NEWBORN') & df_adm.DEATHTIME.isnull()].copy()
 df_adm['DURATION']  = (df_adm['DISCHTIME']-df_adm['ADMITTIME']).dt.total_seconds()/(24*60*60)
 
 
-df_diagnoses = pd.read_csv('/backup/mimiciii/DIAGNOSES_ICD.csv.gz', compression="gzip")
+df_diagnoses = loadMimicTable("DIAGNOSES_ICD", dtype={'ICD9_CODE': str})
 df_diagnoses = df_diagnoses[df_diagnoses.ICD9_CODE.notna()]
 df_diagnoses = df_diagnoses.sort_values(['HADM_ID','SEQ_NUM'], ascending=True)
 df_diagnoses = df_diagnoses.reset_index(drop = True)
-df_diagnoses.ICD9_CODE = "D_" + df_diagnoses.ICD9_CODE.astype(str)
+df_diagnoses.ICD9_CODE = df_diagnoses.ICD9_CODE.astype('category').cat.rename_categories(lambda code: "D_" + str(code))
 df_diag_listing = df_diagnoses.groupby('HADM_ID')['ICD9_CODE'].apply(list)
 df_diag_listing = df_diag_listing.reset_index()
 diagnosesCCS, smallICDs = map_ICD9_to_CCS(df_diag_listing)
@@ -274,10 +306,10 @@ df_adm = pd.merge(df_adm,
 
 df_adm = df_adm.rename(columns={'ICD9_CODE': 'DIAG_ICD9'})
 
-df_procedures = pd.read_csv('/backup/mimiciii/PROCEDURES_ICD.csv.gz', compression="gzip")
+df_procedures = loadMimicTable("PROCEDURES_ICD", dtype={'ICD9_CODE': str})
 df_procedures = df_procedures.sort_values(['HADM_ID','SEQ_NUM'], ascending=True)
 df_procedures = df_procedures.reset_index(drop = True)
-df_procedures.ICD9_CODE = "P_" + df_procedures.ICD9_CODE.astype(str)
+df_procedures.ICD9_CODE = df_procedures.ICD9_CODE.astype('category').cat.rename_categories(lambda code: "P_" + str(code))
 df_proc_listing = df_procedures.groupby('HADM_ID')['ICD9_CODE'].apply(list)
 df_proc_listing = df_proc_listing.reset_index()
 proceduresCCS, smallICDs = map_ICD9_to_CCS(df_proc_listing)
@@ -292,7 +324,7 @@ df_adm = pd.merge(df_adm,
 df_adm = df_adm.rename(columns={'ICD9_CODE': 'PROC_ICD9'})
 
 
-df_medication = pd.read_csv('/backup/mimiciii/PRESCRIPTIONS.csv.gz', compression="gzip")
+df_medication = loadMimicTable("PRESCRIPTIONS", usecols=['HADM_ID','STARTDATE','NDC'], dtype={'NDC': float})
 df_medication = df_medication.sort_values(['HADM_ID','STARTDATE'], ascending=True)
 df_medication = df_medication.reset_index(drop = True)
 # df_med_listing1 = df_medication.groupby('HADM_ID')['DRUG'].apply(list)
@@ -307,13 +339,14 @@ df_adm = pd.merge(df_adm,
                   on = ['HADM_ID'],
                   how = 'left')
 
-df_adm['NEXT_SMALL_DIAG_ICD9'] = df_adm.groupby('SUBJECT_ID').SMALL_DIAG_ICD9.shift(-1)
-df_adm['NEXT_DIAG_CCS'] = df_adm.groupby('SUBJECT_ID').DIAG_CCS.shift(-1)
-df_adm['NEXT_SMALL_PROC_ICD9'] = df_adm.groupby('SUBJECT_ID').SMALL_PROC_ICD9.shift(-1)
-df_adm['NEXT_PROC_CCS'] = df_adm.groupby('SUBJECT_ID').PROC_CCS.shift(-1)
-df_adm['NEXT_CUI'] = df_adm.groupby('SUBJECT_ID').CUI.shift(-1)
+next_admission_columns = ['SMALL_DIAG_ICD9','DIAG_CCS','SMALL_PROC_ICD9','PROC_CCS','CUI']
+df_adm[['NEXT_'+column for column in next_admission_columns]] = df_adm.groupby('SUBJECT_ID')[next_admission_columns].shift(-1)
 
-df_notes = pd.read_csv('/backup/mimiciii/NOTEEVENTS.csv.gz', compression="gzip")
+# Notes from admissions that were filtered out above (newborns, deaths) are dropped while loading, before sorting and merging their TEXT.
+# HADM_ID is a float column in NOTEEVENTS since some notes have no admission
+df_notes = loadMimicTable("NOTEEVENTS", rowFilter=('HADM_ID', df_adm.HADM_ID.astype('float64').unique().tolist()),
+                          usecols=['SUBJECT_ID','HADM_ID','CHARTDATE','CHARTTIME','CATEGORY','TEXT'])
+df_notes['CATEGORY'] = df_notes['CATEGORY'].astype('category')
 df_notes = df_notes.sort_values(by=['SUBJECT_ID','HADM_ID','CHARTDATE'])
 df_adm_notes = pd.merge(df_adm[['SUBJECT_ID','HADM_ID','ADMITTIME','DISCHTIME','DAYS_NEXT_ADMIT','DAYS_PREV_ADMIT','NEXT_ADMITTIME','ADMISSION_TYPE',
                                 'DEATHTIME','OUTPUT_LABEL','DURATION','DIAG_ICD9','SMALL_DIAG_ICD9','DIAG_CCS','PROC_ICD9','SMALL_PROC_ICD9',
@@ -343,25 +376,12 @@ def less_n_days_data (df_adm_notes, n):
     df_less_n = df_less_n[df_less_n['TEXT'].notnull()]
     #concatenate first
     df_concat = pd.DataFrame(df_less_n.groupby('HADM_ID')['TEXT'].apply(lambda x: "%s" % ' '.join(x))).reset_index()
-    df_concat['OUTPUT_LABEL'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].OUTPUT_LABEL.values[0])
-    df_concat['SUBJECT_ID'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].SUBJECT_ID.values[0])
-    df_concat['ADMITTIME'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].ADMITTIME.values[0])
-    df_concat['DAYS_NEXT_ADMIT'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].DAYS_NEXT_ADMIT.values[0])
-    df_concat['DAYS_PREV_ADMIT'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].DAYS_PREV_ADMIT.values[0])
-    df_concat['DURATION'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].DURATION.values[0])
-    df_concat['DIAG_ICD9'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].DIAG_ICD9.values[0])
-    df_concat['SMALL_DIAG_ICD9'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].SMALL_DIAG_ICD9.values[0])
-    df_concat['DIAG_CCS'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].DIAG_CCS.values[0])
-    df_concat['PROC_ICD9'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].PROC_ICD9.values[0])
-    df_concat['SMALL_PROC_ICD9'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].SMALL_PROC_ICD9.values[0])
-    df_concat['PROC_CCS'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].PROC_CCS.values[0])
-    df_concat['NDC'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].NDC.values[0])
-    df_concat['CUI'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].CUI.values[0])
-    df_concat['NEXT_SMALL_DIAG_ICD9'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].NEXT_SMALL_DIAG_ICD9.values[0])
-    df_concat['NEXT_DIAG_CCS'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].NEXT_DIAG_CCS.values[0])
-    df_concat['NEXT_SMALL_PROC_ICD9'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].NEXT_SMALL_PROC_ICD9.values[0])
-    df_concat['NEXT_PROC_CCS'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].NEXT_PROC_CCS.values[0])
-    df_concat['NEXT_CUI'] = df_concat['HADM_ID'].apply(lambda x: df_less_n[df_less_n['HADM_ID']==x].NEXT_CUI.values[0])  
+    # The admission columns are repeated on every note of an admission, so they are taken from its first note with a single join
+    admissionColumns = ['OUTPUT_LABEL','SUBJECT_ID','ADMITTIME','DAYS_NEXT_ADMIT','DAYS_PREV_ADMIT','DURATION','DIAG_ICD9','SMALL_DIAG_ICD9',
+                        'DIAG_CCS','PROC_ICD9','SMALL_PROC_ICD9','PROC_CCS','NDC','CUI','NEXT_SMALL_DIAG_ICD9','NEXT_DIAG_CCS',
+                        'NEXT_SMALL_PROC_ICD9','NEXT_PROC_CCS','NEXT_CUI']
+    df_admissions = df_less_n.drop_duplicates('HADM_ID')[['HADM_ID']+admissionColumns]
+    df_concat = df_concat.merge(df_admissions, on='HADM_ID', how='left')
     df_concat = df_concat.sort_values(by=['SUBJECT_ID','HADM_ID'])
     df_concat = df_concat.reset_index(drop = True)
     return df_concat
@@ -372,55 +392,63 @@ df_less_3 = less_n_days_data(df_adm_notes, 3)
 print("LOADED THE DATA")
 
 import re
+try:
+    # When installed, google-re2 matches the pattern below with a linear-time DFA and is used as a drop-in replacement for re
+    import re2 as noteRegex
+except ImportError:
+    noteRegex = re
+# The note cleanup rules are merged in a single pattern so that each note is scanned once:
+# de-identified brackets, 1.2. enumerations (the segmenter segments based on this), doctor titles,
+# admission/discharge date headers and --, __, == separators. Only the titles are replaced by something other than ''
+notePattern = noteRegex.compile('\\[(.*?)\\]|[0-9]+\\.|dr\\.|m\\.d\\.|admission date:|discharge date:|--|__|==')
+noteReplacements = {'dr.':'doctor', 'm.d.':'md'}
+
+def noteReplacement(match):
+    return noteReplacements.get(match.group(0), '')
+
 def preprocess1(x):
-    y=re.sub('\\[(.*?)\\]','',x) #remove de-identified brackets
-    y=re.sub('[0-9]+\.','',y) #remove 1.2. since the segmenter segments based on this
-    y=re.sub('dr\.','doctor',y)
-    y=re.sub('m\.d\.','md',y)
-    y=re.sub('admission date:','',y)
-    y=re.sub('discharge date:','',y)
-    y=re.sub('--|__|==','',y)
-    return y
+    return notePattern.sub(noteReplacement, x)
+
+newlineTable = str.maketrans({'\n':' ', '\r':' '})
+
+def cleanNote(x):
+    """
+    Replaces line breaks by spaces, strips and lowercases a note before applying preprocess1, all in a single call per note.
+    """
+    return preprocess1(x.translate(newlineTable).strip().lower())
+
+def chunkNote(text):
+    """
+    Splits a note in chunks of 318 words. The remaining words are only kept as a last chunk if there are more than 10 of them.
+    """
+    x=text.split()
+    remainder=len(x)%318
+    chunks=[' '.join(x[k:k+318]) for k in range(0, len(x)-remainder, 318)]
+    if remainder>10:
+        chunks.append(' '.join(x[-remainder:]))
+    return chunks
 
 def preprocessing(df_less_n):
-    df_less_n['TEXT']=df_less_n['TEXT'].fillna(' ')
-    df_less_n['TEXT']=df_less_n['TEXT'].str.replace('\n',' ')
-    df_less_n['TEXT']=df_less_n['TEXT'].str.replace('\r',' ')
-    df_less_n['TEXT']=df_less_n['TEXT'].apply(str.strip)
-    df_less_n['TEXT']=df_less_n['TEXT'].str.lower()
-    df_less_n['TEXT']=df_less_n['TEXT'].apply(lambda x: preprocess1(x))
+    df_less_n['TEXT']=df_less_n['TEXT'].fillna(' ').map(cleanNote)
     #to get 318 words chunks for readmission tasks
     from tqdm import tqdm
     df_len = len(df_less_n)
     #want=pd.DataFrame({'ID':[],'DIAG_ICD9':[],'DIAG_CCS':[],'PROC_ICD9':[],'PROC_CCS':[],'NDC':[],'TEXT':[],'Label':[]})
-    want=pd.DataFrame({'HADM_ID':[],'SUBJECT_ID':[],'ADMITTIME':[],'DAYS_NEXT_ADMIT':[],'DAYS_PREV_ADMIT':[],'DURATION':[],'DIAG_ICD9':[],
-                       'SMALL_DIAG_ICD9':[],'DIAG_CCS':[],'PROC_ICD9':[],'SMALL_PROC_ICD9':[],'PROC_CCS':[],'NDC':[],'CUI':[],'TEXT':[],'Label':[],
-                       'NEXT_SMALL_DIAG_ICD9':[],'NEXT_DIAG_CCS':[],'NEXT_SMALL_PROC_ICD9':[],'NEXT_PROC_CCS':[],'NEXT_CUI':[]})
-    for i in tqdm(range(df_len)):
-        x=df_less_n.TEXT.iloc[i].split()
-        n=int(len(x)/318)
-        for j in range(n):
-            want=want.append({'TEXT':' '.join(x[j*318:(j+1)*318]),'Label':df_less_n.OUTPUT_LABEL.iloc[i],'HADM_ID':df_less_n.HADM_ID.iloc[i],
-                              'SUBJECT_ID':df_less_n.SUBJECT_ID.iloc[i],'ADMITTIME':df_less_n.ADMITTIME.iloc[i],
-                              'DAYS_NEXT_ADMIT':df_less_n.DAYS_NEXT_ADMIT.iloc[i], 'DAYS_PREV_ADMIT':df_less_n.DAYS_PREV_ADMIT.iloc[i], 
-                              'DURATION':df_less_n.DURATION.iloc[i], 'NDC':df_less_n.NDC.iloc[i], 
-                              'DIAG_ICD9':df_less_n.DIAG_ICD9.iloc[i],'DIAG_CCS':df_less_n.DIAG_CCS.iloc[i],
-                              'PROC_ICD9':df_less_n.PROC_ICD9.iloc[i],'PROC_CCS':df_less_n.PROC_CCS.iloc[i],
-                              'SMALL_DIAG_ICD9':df_less_n.SMALL_DIAG_ICD9.iloc[i],'SMALL_PROC_ICD9':df_less_n.SMALL_PROC_ICD9.iloc[i],
-                              'CUI':df_less_n.CUI.iloc[i], 'NEXT_CUI':df_less_n.NEXT_CUI.iloc[i],
-                              'NEXT_SMALL_DIAG_ICD9':df_less_n.NEXT_SMALL_DIAG_ICD9.iloc[i], 'NEXT_SMALL_PROC_ICD9':df_less_n.NEXT_SMALL_PROC_ICD9.iloc[i],
-                              'NEXT_DIAG_CCS':df_less_n.NEXT_DIAG_CCS.iloc[i], 'NEXT_PROC_CCS':df_less_n.NEXT_PROC_CCS.iloc[i],}, ignore_index=True)                           
-        if len(x)%318>10:
-            want=want.append({'TEXT':' '.join(x[-(len(x)%318):]),'Label':df_less_n.OUTPUT_LABEL.iloc[i],'HADM_ID':df_less_n.HADM_ID.iloc[i],
-                              'SUBJECT_ID':df_less_n.SUBJECT_ID.iloc[i],'ADMITTIME':df_less_n.ADMITTIME.iloc[i],
-                              'DAYS_NEXT_ADMIT':df_less_n.DAYS_NEXT_ADMIT.iloc[i], 'DAYS_PREV_ADMIT':df_less_n.DAYS_PREV_ADMIT.iloc[i], 
-                              'DURATION':df_less_n.DURATION.iloc[i], 'NDC':df_less_n.NDC.iloc[i],
-                              'DIAG_ICD9':df_less_n.DIAG_ICD9.iloc[i],'DIAG_CCS':df_less_n.DIAG_CCS.iloc[i],
-                              'PROC_ICD9':df_less_n.PROC_ICD9.iloc[i],'PROC_CCS':df_less_n.PROC_CCS.iloc[i],
-                              'SMALL_DIAG_ICD9':df_less_n.SMALL_DIAG_ICD9.iloc[i],'SMALL_PROC_ICD9':df_less_n.SMALL_PROC_ICD9.iloc[i],
-                              'CUI':df_less_n.CUI.iloc[i], 'NEXT_CUI':df_less_n.NEXT_CUI.iloc[i],
-                              'NEXT_SMALL_DIAG_ICD9':df_less_n.NEXT_SMALL_DIAG_ICD9.iloc[i], 'NEXT_SMALL_PROC_ICD9':df_less_n.NEXT_SMALL_PROC_ICD9.iloc[i],
-                              'NEXT_DIAG_CCS':df_less_n.NEXT_DIAG_CCS.iloc[i], 'NEXT_PROC_CCS':df_less_n.NEXT_PROC_CCS.iloc[i],}, ignore_index=True)                     
+    wantColumns = ['HADM_ID','SUBJECT_ID','ADMITTIME','DAYS_NEXT_ADMIT','DAYS_PREV_ADMIT','DURATION','DIAG_ICD9',
+                   'SMALL_DIAG_ICD9','DIAG_CCS','PROC_ICD9','SMALL_PROC_ICD9','PROC_CCS','NDC','CUI','TEXT','Label',
+                   'NEXT_SMALL_DIAG_ICD9','NEXT_DIAG_CCS','NEXT_SMALL_PROC_ICD9','NEXT_PROC_CCS','NEXT_CUI']
+    # Columns are pulled out as NumPy arrays once and the DataFrame is built column-wise at the end:
+    # the admission columns are repeated once per chunk of their note
+    texts = df_less_n.TEXT.to_numpy()
+    values = {column: df_less_n[column].to_numpy() for column in wantColumns if column not in ('TEXT','Label')}
+    values['Label'] = df_less_n.OUTPUT_LABEL.to_numpy()
+    # The notes are chunked in parallel; imap keeps the notes in their original order.
+    # The workers are forked: this script has no __main__ guard, so spawned workers would re-run the whole pipeline on import
+    with multiprocessing.get_context("fork").Pool() as pool:
+        noteChunks = list(tqdm(pool.imap(chunkNote, texts, chunksize=64), total=df_len))
+    chunkCounts = np.fromiter((len(chunks) for chunks in noteChunks), dtype=np.int64, count=df_len)
+    chunkTexts = [chunk for chunks in noteChunks for chunk in chunks]
+    want=pd.DataFrame({column: chunkTexts if column == 'TEXT' else np.repeat(values[column], chunkCounts) for column in wantColumns})
     return want
 
 df_discharge = preprocessing(df_discharge)
@@ -464,11 +492,17 @@ val_id_label = pd.DataFrame(data = list(zip(id_val, [1]*len(id_val_t)+[0]*len(id
 id_train = pd.concat([id_train_t, id_train_f])
 train_id_label = pd.DataFrame(data = list(zip(id_train, [1]*len(id_train_t)+[0]*len(id_train_f))), columns = ['id','label'])
 
+# the id sets are reused by every split below, so they are converted once to plain arrays of the HADM_ID dtype
+# (isin on a Series argument rebuilds its lookup table from the Series on each call)
+train_ids = train_id_label.id.to_numpy(dtype=np.int32)
+val_ids = val_id_label.id.to_numpy(dtype=np.int32)
+test_ids = test_id_label.id.to_numpy(dtype=np.int32)
+
 #get discharge train/val/test
 
-discharge_train = df_discharge[df_discharge.HADM_ID.isin(train_id_label.id)]
-discharge_val = df_discharge[df_discharge.HADM_ID.isin(val_id_label.id)]
-discharge_test = df_discharge[df_discharge.HADM_ID.isin(test_id_label.id)]
+discharge_train = df_discharge[df_discharge.HADM_ID.isin(train_ids)]
+discharge_val = df_discharge[df_discharge.HADM_ID.isin(val_ids)]
+discharge_test = df_discharge[df_discharge.HADM_ID.isin(test_ids)]
 
 # subsampling for training....since we obtain training on patient admission level so now we have same number of pos/neg readmission
 # but each admission is associated with different length of notes and we train on each chunks of notes, not on the admission, we need
@@ -482,7 +516,7 @@ df = df.drop_duplicates(keep=False)
 
 # for this set of split with random_state=1, we find we need 400 more negative training samples
 not_readmit_ID_more = df.sample(n=400, random_state=1)
-discharge_train_snippets = pd.concat([df_discharge[df_discharge.HADM_ID.isin(not_readmit_ID_more)], discharge_train])
+discharge_train_snippets = pd.concat([df_discharge[df_discharge.HADM_ID.isin(not_readmit_ID_more.to_numpy())], discharge_train])
 
 #shuffle
 discharge_train_snippets = discharge_train_snippets.sample(frac=1, random_state=1).reset_index(drop=True)
@@ -490,16 +524,29 @@ discharge_train_snippets = discharge_train_snippets.sample(frac=1, random_state=
 #check if balanced
 discharge_train_snippets.Label.value_counts()
 
+splitColumns = ["SUBJECT_ID","HADM_ID","ADMITTIME","DAYS_NEXT_ADMIT","DAYS_PREV_ADMIT","DURATION","DIAG_ICD9","SMALL_DIAG_ICD9","DIAG_CCS","PROC_ICD9","SMALL_PROC_ICD9","PROC_CCS","NDC","CUI","Label","TEXT","NEXT_SMALL_DIAG_ICD9","NEXT_DIAG_CCS","NEXT_SMALL_PROC_ICD9","NEXT_PROC_CCS","NEXT_CUI"]
+
+def writeSplit(df, path):
+    """Writes the splitColumns of a split to csv with the pyarrow writer
+    The list columns are written as their Python repr, the floats with their decimal point (pyarrow writes 2.0 as 2, which
+    read_csv would load back as int) and the timestamps with seconds precision, as pandas' to_csv did"""
+    table = df[splitColumns].copy()
+    for column in table.columns:
+        if pd.api.types.is_datetime64_any_dtype(table[column]):
+            table[column] = table[column].dt.strftime("%Y-%m-%d %H:%M:%S")
+        elif pd.api.types.is_float_dtype(table[column]):
+            table[column] = table[column].astype(str).where(table[column].notna())
+        elif table[column].dtype == object:
+            table[column] = table[column].map(lambda value: str(value) if isinstance(value, list) else value)
+    pacsv.write_csv(pa.Table.from_pandas(table, preserve_index=False), path)
+
 print("BEGINNING SAVING TO CSV")
 
-discharge_train_snippets.to_csv('../data/extended/discharge/train.csv',
-                                columns=["SUBJECT_ID","HADM_ID","ADMITTIME","DAYS_NEXT_ADMIT","DAYS_PREV_ADMIT","DURATION","DIAG_ICD9","SMALL_DIAG_ICD9","DIAG_CCS","PROC_ICD9","SMALL_PROC_ICD9","PROC_CCS","NDC","CUI","Label","TEXT","NEXT_SMALL_DIAG_ICD9","NEXT_DIAG_CCS","NEXT_SMALL_PROC_ICD9","NEXT_PROC_CCS","NEXT_CUI"])
+writeSplit(discharge_train_snippets, '../data/extended/discharge/train.csv')
 
-discharge_val.to_csv('../data/extended/discharge/val.csv',
-                     columns=["SUBJECT_ID","HADM_ID","ADMITTIME","DAYS_NEXT_ADMIT","DAYS_PREV_ADMIT","DURATION","DIAG_ICD9","SMALL_DIAG_ICD9","DIAG_CCS","PROC_ICD9","SMALL_PROC_ICD9","PROC_CCS","NDC","CUI","Label","TEXT","NEXT_SMALL_DIAG_ICD9","NEXT_DIAG_CCS","NEXT_SMALL_PROC_ICD9","NEXT_PROC_CCS","NEXT_CUI"])
+writeSplit(discharge_val, '../data/extended/discharge/val.csv')
 
-discharge_test.to_csv('../data/extended/discharge/test.csv',
-                     columns=["SUBJECT_ID","HADM_ID","ADMITTIME","DAYS_NEXT_ADMIT","DAYS_PREV_ADMIT","DURATION","DIAG_ICD9","SMALL_DIAG_ICD9","DIAG_CCS","PROC_ICD9","SMALL_PROC_ICD9","PROC_CCS","NDC","CUI","Label","TEXT","NEXT_SMALL_DIAG_ICD9","NEXT_DIAG_CCS","NEXT_SMALL_PROC_ICD9","NEXT_PROC_CCS","NEXT_CUI"])
+writeSplit(discharge_test, '../data/extended/discharge/test.csv')
 
 ### for Early notes experiment: we only need to find training set for 3 days, then we can test
 ### both 3 days and 2 days. Since we split the data on patient level and experiments share admissions
@@ -509,34 +556,20 @@ discharge_test.to_csv('../data/extended/discharge/test.csv',
 
 #for 3 days note, similar to discharge
 
-early_train = df_less_3[df_less_3.HADM_ID.isin(train_id_label.id)]
+early_train = df_less_3[df_less_3.HADM_ID.isin(train_ids)]
 not_readmit_ID_more = df.sample(n=500, random_state=1)
-early_train_snippets = pd.concat([df_less_3[df_less_3.HADM_ID.isin(not_readmit_ID_more)], early_train])
+early_train_snippets = pd.concat([df_less_3[df_less_3.HADM_ID.isin(not_readmit_ID_more.to_numpy())], early_train])
 #shuffle
 early_train_snippets = early_train_snippets.sample(frac=1, random_state=1).reset_index(drop=True)
-early_train_snippets.to_csv('../data/extended/3days/train.csv',
-                            columns=["SUBJECT_ID","HADM_ID","ADMITTIME","DAYS_NEXT_ADMIT","DAYS_PREV_ADMIT","DURATION","DIAG_ICD9","SMALL_DIAG_ICD9","DIAG_CCS","PROC_ICD9","SMALL_PROC_ICD9","PROC_CCS","NDC","CUI","Label","TEXT","NEXT_SMALL_DIAG_ICD9","NEXT_DIAG_CCS","NEXT_SMALL_PROC_ICD9","NEXT_PROC_CCS","NEXT_CUI"])
+writeSplit(early_train_snippets, '../data/extended/3days/train.csv')
 
-early_val = df_less_3[df_less_3.HADM_ID.isin(val_id_label.id)]
-early_val.to_csv('../data/extended/3days/val.csv',
-                 columns=["SUBJECT_ID","HADM_ID","ADMITTIME","DAYS_NEXT_ADMIT","DAYS_PREV_ADMIT","DURATION","DIAG_ICD9","SMALL_DIAG_ICD9","DIAG_CCS","PROC_ICD9","SMALL_PROC_ICD9","PROC_CCS","NDC","CUI","Label","TEXT","NEXT_SMALL_DIAG_ICD9","NEXT_DIAG_CCS","NEXT_SMALL_PROC_ICD9","NEXT_PROC_CCS","NEXT_CUI"])
-
-# we want to test on admissions that are not discharged already. So for less than 3 days of notes experiment,
-# we filter out admissions discharged within 3 days
-actionable_ID_3days = df_adm[df_adm['DURATION'] >= 3].HADM_ID
-test_actionable_id_label = test_id_label[test_id_label.id.isin(actionable_ID_3days)]
-early_test = df_less_3[df_less_3.HADM_ID.isin(test_actionable_id_label.id)]
-
-early_test.to_csv('../data/extended/3days/test.csv',
-                  columns=["SUBJECT_ID","HADM_ID","ADMITTIME","DAYS_NEXT_ADMIT","DAYS_PREV_ADMIT","DURATION","DIAG_ICD9","SMALL_DIAG_ICD9","DIAG_CCS","PROC_ICD9","SMALL_PROC_ICD9","PROC_CCS","NDC","CUI","Label","TEXT","NEXT_SMALL_DIAG_ICD9","NEXT_DIAG_CCS","NEXT_SMALL_PROC_ICD9","NEXT_PROC_CCS","NEXT_CUI"])
+early_val = df_less_3[df_less_3.HADM_ID.isin(val_ids)]
+writeSplit(early_val, '../data/extended/3days/val.csv')
 
+# we want to test on admissions that are not discharged already. So for less than n days of notes experiment,
+# we filter out admissions discharged within n days. The notes carry the DURATION of their admission, so both
+# conditions are a single mask over each frame
 #for 2 days notes, we only obtain test set. Since the model parameters are tuned on the val set of 3 days
-
-actionable_ID_2days = df_adm[df_adm['DURATION'] >= 2].HADM_ID
-
-test_actionable_id_label_2days = test_id_label[test_id_label.id.isin(actionable_ID_2days)]
-
-early_test_2days = df_less_2[df_less_2.HADM_ID.isin(test_actionable_id_label_2days.id)]
-
-early_test_2days.to_csv('../data/extended/2days/test.csv',
-                        columns=["SUBJECT_ID","HADM_ID","ADMITTIME","DAYS_NEXT_ADMIT","DAYS_PREV_ADMIT","DURATION","DIAG_ICD9","SMALL_DIAG_ICD9","DIAG_CCS","PROC_ICD9","SMALL_PROC_ICD9","PROC_CCS","NDC","CUI","Label","TEXT","NEXT_SMALL_DIAG_ICD9","NEXT_DIAG_CCS","NEXT_SMALL_PROC_ICD9","NEXT_PROC_CCS","NEXT_CUI"])
+for days, df_less_n in [(3, df_less_3), (2, df_less_2)]:
+    early_test_n = df_less_n[df_less_n.HADM_ID.isin(test_ids) & (df_less_n.DURATION >= days)]
+    writeSplit(early_test_n, '../data/extended/%ddays/test.csv' % days)
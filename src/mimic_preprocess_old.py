@@ -193,7 +193,8 @@ def get_unique_ordered_medication(pandasDataFrame):
                     value = -1 # Swapping NaNs to a default numerical number that is not used elsewhere
                 unique_medication.append(int(value))
 
-            if (int(value) is not -1) and (int(value) in RxNormNdcs):
+            intValue = int(value)
+            if (intValue != -1) and (intValue in RxNormNdcs):
                 mapped+=1
             else:
                 unmapped+=1
@@ -30,7 +30,7 @@ import shutil
 import torch
 import numpy as np
 from torch import nn
-from torch.nn import CrossEntropyLoss, BCELoss
+from torch.nn import CrossEntropyLoss, BCEWithLogitsLoss
 from torch.nn.functional import mish as Mish
 from torch.nn.functional import relu as ReLU
 
@@ -1011,12 +1011,12 @@ class BertForSequenceClassificationOriginal(PreTrainedBertModel):
         logits = self.classifier(pooled_output2)
 
         if labels is not None:
-            loss_fct = BCELoss()
-            m = nn.Sigmoid()
+            # The sigmoid is fused into the loss, which is also the form autocast accepts in fp16
+            loss_fct = BCEWithLogitsLoss()
             #n = torch.squeeze(m(logits))
             #loss = loss_fct(n, labels.float())
             #loss = loss_fct(n.reshape(-1,1), labels.float().reshape(-1,1))
-            n = torch.squeeze(m(logits), dim=-1)
+            n = torch.squeeze(logits, dim=-1)
             loss = loss_fct(n, labels.float())
             return loss, logits
         else:
@@ -1073,6 +1073,8 @@ class BertForSequenceClassification(PreTrainedBertModel):
         super(BertForSequenceClassification, self).__init__(config)
         self.bert = BertModel(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        # Set together with requires_grad=False on the BERT parameters, so its activations are not kept for backward
+        self.freeze_bert = False
         
         classifier_size = 0
         
@@ -1133,7 +1135,8 @@ class BertForSequenceClassification(PreTrainedBertModel):
         layer_outputs = []
         if features_name is not None:
             if "clinical_text" in features_name:
-                _, bert_pooled_output = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
+                with torch.set_grad_enabled(torch.is_grad_enabled() and not self.freeze_bert):
+                    _, bert_pooled_output = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
                 pooled_output2 = self.dropout(bert_pooled_output)
                 layer_outputs.append(pooled_output2)
             if "admittime" in features_name:
@@ -1198,10 +1201,10 @@ class BertForSequenceClassification(PreTrainedBertModel):
         logits = self.classifier(output)
         
         if labels is not None:
-            loss_fct = BCELoss()
-            m = nn.Sigmoid()
+            # The sigmoid is fused into the loss, which is also the form autocast accepts in fp16
+            loss_fct = BCEWithLogitsLoss()
 # NOTE: for multi class the sigmoid activation must be changed to softmax and the loss must be changed from binary cross entropy to cross entropy
-            n = torch.squeeze(m(logits), dim=-1)
+            n = torch.squeeze(logits, dim=-1)
             loss = loss_fct(n, labels.float())
             return loss, logits
         else:
@@ -23,6 +23,9 @@ import os
 import logging
 import argparse
 import random
+import gc
+import hashlib
+import threading
 import pandas as pd
 import numpy as np
 from tqdm import trange, tqdm
@@ -39,43 +42,117 @@ import torch
 from torch import nn
 from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
-from pytorch_pretrained_bert.tokenization import BertTokenizer
+from safetensors.torch import save_file
+from transformers import BertTokenizerFast
 from pytorch_pretrained_bert.optimization import BertAdam
-from ranger21 import Ranger21 as RangerOptimizer
 #important
 
 from modeling_readmission import BertForSequenceClassification, BertForSequenceClassificationOriginal
 from data_processor import convert_examples_to_features, readmissionProcessor
 from evaluation import vote_score, vote_pr_curve
 
-def copy_optimizer_params_to_model(named_params_model, named_params_optimizer):
-    """ Utility function for optimize_on_cpu and 16-bits training.
-        Copy the parameters optimized on CPU/RAM back to the model on GPU
+def stack_fields(features, fields):
+    """ Stacks the given (name, dtype) fields of all the InputFeatures into one tensor per field.
+        The arrays are preallocated from the shapes of the first feature and filled in a single pass over the features,
+        avoiding the nested Python lists torch.tensor would go through
     """
-    for (name_opti, param_opti), (name_model, param_model) in zip(named_params_optimizer, named_params_model):
-        if name_opti != name_model:
-            logger.error("name_opti != name_model: {} {}".format(name_opti, name_model))
-            raise ValueError
-        param_model.data.copy_(param_opti.data)
-
-def set_optimizer_params_grad(named_params_optimizer, named_params_model, test_nan=False):
-    """ Utility function for optimize_on_cpu and 16-bits training.
-        Copy the gradient of the GPU parameters to the CPU/RAMM copy of the model
+    arrays = [np.empty((len(features),) + np.shape(getattr(features[0], name)), dtype=dtype) for name, dtype in fields]
+    names = [name for name, _ in fields]
+    for i, feature in enumerate(features):
+        for name, array in zip(names, arrays):
+            array[i] = getattr(feature, name)
+    return [torch.from_numpy(array) for array in arrays]
+
+# Token ids, masks and code ids all fit in 32 bits, which halves the bytes copied to the device for every batch.
+# The labels stay int64 for the loss
+TOKEN_DTYPE = np.int32
+
+# Additional features that can be fed to the model, in the order their tensors are added to the datasets
+FEATURE_SPECS = [("admittime", np.int64), ("daystonextadmit", np.int64), ("duration", np.int64), ("diag_icd9", TOKEN_DTYPE),
+                 ("diag_ccs", TOKEN_DTYPE), ("proc_icd9", TOKEN_DTYPE), ("proc_ccs", TOKEN_DTYPE), ("ndc", TOKEN_DTYPE)]
+
+# Mappings from codes to indices read by convert_examples_to_features for the additional features
+IDX_FILES = ["../data/extended/preprocessing/idxFiles/" + name for name in ("smallIcd9ToIdx.json", "CCSToIdx.json", "cui_NDCToIdx.json")]
+
+def feature_positions(additional_features):
+    """ Position of each selected additional feature among the additional feature tensors, as expected by the model
     """
-    is_nan = False
-    for (name_opti, param_opti), (name_model, param_model) in zip(named_params_optimizer, named_params_model):
-        if name_opti != name_model:
-            logger.error("name_opti != name_model: {} {}".format(name_opti, name_model))
-            raise ValueError
-        if param_model.grad is not None:
-            if test_nan and torch.isnan(param_model.grad).sum() > 0:
-                is_nan = True
-            if param_opti.grad is None:
-                param_opti.grad = torch.nn.Parameter(param_opti.data.new().resize_(*param_opti.data.size()))
-            param_opti.grad.data.copy_(param_model.grad.data)
-        else:
-            param_opti.grad = None
-    return is_nan
+    selected = [name for name, _ in FEATURE_SPECS if additional_features is not None and name in additional_features]
+    return {name: position for position, name in enumerate(selected)}
+
+def load_feature_tensors(args, processor, split, label_list, tokenizer, maxLenDict):
+    """ Returns the dataset tensors of a split: input ids, input mask, segment ids, labels and the selected additional features.
+        They are cached in data_dir as an npz file keyed on everything they depend on, so later runs skip the tokenization
+    """
+    # The modification time of the csv invalidates the cache when mimic_preprocess regenerates the split
+    splitFile = os.path.join(args.data_dir, split + ".csv")
+    # The additional features are indexed through the idx files, so regenerating any of them invalidates the cache as well
+    idxFiles = [(path, os.path.getmtime(path), os.path.getsize(path)) for path in IDX_FILES if os.path.isfile(path)]
+    key = "{}|{}|{}|{}|{}|{}|{}|{}|{}".format(splitFile, os.path.getmtime(splitFile), args.max_seq_length, tokenizer.name_or_path,
+                                              sorted(args.additional_features or []), sorted(maxLenDict.items()), idxFiles,
+                                              np.dtype(TOKEN_DTYPE).name, [(name, np.dtype(dtype).name) for name, dtype in FEATURE_SPECS])
+    cacheFile = os.path.join(args.data_dir, "features_{}.npz".format(hashlib.md5(key.encode()).hexdigest()))
+    if os.path.isfile(cacheFile):
+        with np.load(cacheFile) as arrays:
+            return [torch.from_numpy(arrays["arr_{}".format(i)]) for i in range(len(arrays.files))]
+
+    getExamples = processor.get_train_examples if split == "train" else processor.get_test_examples
+    examples = getExamples(args.data_dir, args.additional_features)
+    features = convert_examples_to_features(
+        examples, label_list, args.max_seq_length, tokenizer, args.additional_features, maxLenDict)
+    fields = [('input_ids', TOKEN_DTYPE), ('input_mask', TOKEN_DTYPE), ('segment_ids', TOKEN_DTYPE), ('label_id', np.int64)]
+    positions = feature_positions(args.additional_features)
+    fields += [(name, dtype) for name, dtype in FEATURE_SPECS if name in positions]
+    tensors = stack_fields(features, fields)
+    # The examples keep the raw note texts and the features a second copy of the tensors, neither is used from here on
+    del examples, features
+    gc.collect()
+
+    if args.local_rank in [-1, 0]:
+        # Written under a temporary name first, so an interrupted run does not leave a partial cache behind
+        np.savez(cacheFile + ".tmp.npz", *[tensor.numpy() for tensor in tensors])
+        os.replace(cacheFile + ".tmp.npz", cacheFile)
+    return tensors
+
+def build_tensor_dataset(args, processor, split, label_list, tokenizer, maxLenDict):
+    """ Returns the TensorDataset of a split and the position of its additional features, as expected by the model
+    """
+    tensors = load_feature_tensors(args, processor, split, label_list, tokenizer, maxLenDict)
+    return TensorDataset(*tensors), feature_positions(args.additional_features)
+
+class CUDAPrefetcher(object):
+    """ Wraps a DataLoader and yields its batches already moved to the device.
+        On CUDA the copy of the next batch is issued on a side stream while the current one is being computed
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream() if device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _load(self, batches):
+        batch = next(batches, None)
+        if batch is None or self.stream is None:
+            return batch
+        with torch.cuda.stream(self.stream):
+            return [t.to(self.device, non_blocking=True) for t in batch]
+
+    def __iter__(self):
+        batches = iter(self.loader)
+        if self.stream is None:
+            for batch in batches:
+                yield [t.to(self.device) for t in batch]
+            return
+        batch = self._load(batches)
+        while batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            for t in batch:
+                t.record_stream(torch.cuda.current_stream())
+            nextBatch = self._load(batches)
+            yield batch
+            batch = nextBatch
 
 
 def main():
@@ -147,7 +224,7 @@ def main():
     parser.add_argument("--local_rank",
                         type=int,
                         default=-1,
-                        help="local_rank for distributed training on gpus")
+                        help="local_rank for distributed training on gpus. Set from the LOCAL_RANK variable when launched with torchrun")
     parser.add_argument('--seed', 
                         type=int, 
                         default=42,
@@ -156,17 +233,10 @@ def main():
                         type=int,
                         default=1,
                         help="Number of updates steps to accumulate before performing a backward/update pass.")                       
-    parser.add_argument('--optimize_on_cpu',
-                        default=False,
-                        action='store_true',
-                        help="Whether to perform optimization and keep the optimizer averages on CPU")
     parser.add_argument('--fp16',
                         default=False,
                         action='store_true',
-                        help="Whether to use 16-bit float precision instead of 32-bit")
-    parser.add_argument('--loss_scale',
-                        type=float, default=128,
-                        help='Loss scaling, positive power of 2 values can improve fp16 convergence.')
+                        help="Whether to use mixed 16-bit float precision (autocast with a dynamic loss scaling) instead of 32-bit")
     parser.add_argument('-feat','--additional_features',
                         default=None,
                         nargs="*",
@@ -182,9 +252,21 @@ def main():
                         default=200,
                         help="max length for ndc tensors")
     parser.add_argument('--freeze_bert',
+                        default=True,
+                        action='store_true',
+                        help="Whether to freeze parameters from BERT layers or not. When frozen, these are not updated during model training. On by default.")
+    parser.add_argument('--unfreeze_bert',
+                        dest='freeze_bert',
+                        action='store_false',
+                        help="Train the parameters from BERT layers as well, instead of freezing them.")
+    parser.add_argument('--torch_compile',
                         default=False,
                         action='store_true',
-                        help="Whether to freeze parameters from BERT layers or not. When frozen, these are not updated during model training.")
+                        help="Whether to compile the model with torch.compile (TorchInductor) before training and evaluation.")
+    parser.add_argument('--dataloader_num_workers',
+                        type=int,
+                        default=4,
+                        help="Number of worker processes loading the batches. 0 loads them in the main process.")
 
     args = parser.parse_args()
     
@@ -209,19 +291,29 @@ def main():
 
     maxLenDict={"icd9_ccs_maxlen": args.icd9_ccs_maxlength, "ndc_maxlen": args.ndc_maxlength}
 
+    if args.local_rank == -1 and int(os.environ.get("WORLD_SIZE", 1)) > 1:
+        args.local_rank = int(os.environ["LOCAL_RANK"])
+
     if args.local_rank == -1 or args.no_cuda:
         device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
         n_gpu = torch.cuda.device_count()
+        if n_gpu > 1:
+            # Multiple GPUs are only used through DistributedDataParallel, one process per GPU
+            logger.warning("%d GPUs found but only one is used, launch with torchrun --nproc_per_node=%d to use all of them", n_gpu, n_gpu)
+            n_gpu = 1
     else:
+        torch.cuda.set_device(args.local_rank)
         device = torch.device("cuda", args.local_rank)
         n_gpu = 1
         # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
         torch.distributed.init_process_group(backend='nccl')
-        if args.fp16:
-            logger.info("16-bits training currently not supported in distributed training")
-            args.fp16 = False # (see https://github.com/pytorch/pytorch/pull/13496)
     logger.info("device %s n_gpu %d distributed training %r", device, n_gpu, bool(args.local_rank != -1))
 
+    # Let Ampere and newer GPUs run the fp32 matmuls and convolutions on TF32 tensor cores
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+
     if args.gradient_accumulation_steps < 1:
         raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(
                             args.gradient_accumulation_steps))
@@ -251,7 +343,7 @@ def main():
     processor = processors[task_name]()
     label_list = processor.get_labels()
 
-    tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+    tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
 
     model = BertForSequenceClassification.from_pretrained(args.bert_model, 1, args.additional_features)
     # model = BertForSequenceClassificationOriginal.from_pretrained(args.bert_model, 1)
@@ -261,14 +353,28 @@ def main():
 
     # print(list(model.named_parameters()))
 # SEE THIS AND CHANGE MODEL NAMED PARAMETERS TO SEE WHAT PARAMETERS ARE APPEARING, WITHOUT THE GIANT TENSORS IN THE OUTPUT
-    if args.fp16:
-        model.half()
+    if args.do_train and args.freeze_bert:
+        # Frozen before the DDP wrap, which only hooks the parameters that require grad
+        for param in model.bert.parameters():
+            param.requires_grad = False
+        model.freeze_bert = True
+
     model.to(device)
     if args.local_rank != -1:
+        # The graph is the same on every step, which lets DDP reuse its gradient buckets and overlap the allreduces
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
-                                                          output_device=args.local_rank)
-    elif n_gpu > 1:
-        model = torch.nn.DataParallel(model)
+                                                          output_device=args.local_rank,
+                                                          gradient_as_bucket_view=True,
+                                                          static_graph=True)
+    if args.torch_compile:
+        # Compiled in place, so the parameter names and the saved state_dict keys stay the same.
+        # Sequences are always padded to max_seq_length, so the shapes are static
+        model.compile(dynamic=False)
+
+    # Pinned batches let CUDAPrefetcher copy them to the device asynchronously (non_blocking) with the previous step
+    loaderArgs = {"num_workers": args.dataloader_num_workers, "pin_memory": device.type == "cuda"}
+    if args.dataloader_num_workers > 0:
+        loaderArgs.update(persistent_workers=True, prefetch_factor=2)
 
     global_step = 0
     train_loss=100000
@@ -278,146 +384,66 @@ def main():
         
     if args.do_train:
 
-        #if freeze_bert:
-        for name, param in model.named_parameters():
-            if name.startswith("bert"):
-                param.requires_grad = False
-
-        # Prepare optimizer
-        if args.fp16:
-            param_optimizer = [(n, param.clone().detach().to('cpu').float().requires_grad_()) \
-                                for n, param in model.named_parameters()]
-        elif args.optimize_on_cpu:
-            param_optimizer = [(n, param.clone().detach().to('cpu').requires_grad_()) \
-                                for n, param in model.named_parameters()]
-        else:
-            param_optimizer = list(model.named_parameters())
-        no_decay = ['bias', 'gamma', 'beta']
+        # Prepare optimizer, leaving out the frozen parameters
+        param_optimizer = [(n, param) for n, param in model.named_parameters() if param.requires_grad]
+        no_decay = ('bias', 'gamma', 'beta')
+        decay_params, no_decay_params = [], []
+        for n, p in param_optimizer:
+            (no_decay_params if any(nd in n for nd in no_decay) else decay_params).append(p)
         optimizer_grouped_parameters = [
-            {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.01},
-            {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.0}
+            {'params': decay_params, 'weight_decay': 0.01},
+            {'params': no_decay_params, 'weight_decay': 0.0}
             ]
         # optimizer = BertAdam(optimizer_grouped_parameters,
         #                      lr=args.learning_rate,
         #                      warmup=args.warmup_proportion,
         #                      t_total=num_train_steps)
         
-        train_examples = processor.get_train_examples(args.data_dir, args.additional_features)
-        num_train_steps = int(len(train_examples) / args.train_batch_size / args.gradient_accumulation_steps * args.num_train_epochs)
-        
-        train_features = convert_examples_to_features(
-            train_examples, label_list, args.max_seq_length, tokenizer, args.additional_features, maxLenDict)
+        train_data, featurePositionDict = build_tensor_dataset(args, processor, "train", label_list, tokenizer, maxLenDict)
+        num_train_steps = int(len(train_data) / args.train_batch_size / args.gradient_accumulation_steps * args.num_train_epochs)
         logger.info("***** Running training *****")
-        logger.info("  Num examples = %d", len(train_examples))
+        logger.info("  Num examples = %d", len(train_data))
         logger.info("  Batch size = %d", args.train_batch_size)
         logger.info("  Num steps = %d", num_train_steps)
-        all_input_ids   = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_input_mask  = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-        all_label_ids   = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
-        tensors = [all_input_ids, all_input_mask, all_segment_ids, all_label_ids]
-
-        featurePositionDict = {}
-        positionIdx=0
-        # additionalFeatureOrder = [feature for feature in args.additional_features]
-        if args.additional_features is not None:
-            if "admittime" in args.additional_features:
-                tensors.append(torch.tensor([f.admittime for f in train_features], dtype=torch.long))
-                featurePositionDict["admittime"] = positionIdx
-                positionIdx+=1
-            if "daystonextadmit" in args.additional_features:
-                tensors.append(torch.tensor([f.daystonextadmit for f in train_features], dtype=torch.long))
-                featurePositionDict["daystonextadmit"] = positionIdx
-                positionIdx+=1
-            if "duration"  in args.additional_features:
-                tensors.append(torch.tensor([f.duration for f in train_features], dtype=torch.long))
-                featurePositionDict["duration"] = positionIdx
-                positionIdx+=1
-            if "diag_icd9" in args.additional_features:
-                tensors.append(torch.tensor([f.diag_icd9 for f in train_features], dtype=torch.long))
-                featurePositionDict["diag_icd9"] = positionIdx
-                positionIdx+=1
-            if "diag_ccs"  in args.additional_features:
-                tensors.append(torch.tensor([f.diag_ccs for f in train_features], dtype=torch.long))
-                featurePositionDict["diag_ccs"] = positionIdx
-                positionIdx+=1
-            if "proc_icd9" in args.additional_features:
-                tensors.append(torch.tensor([f.proc_icd9 for f in train_features], dtype=torch.long))
-                featurePositionDict["proc_icd9"] = positionIdx
-                positionIdx+=1
-            if "proc_ccs"  in args.additional_features:
-                tensors.append(torch.tensor([f.proc_ccs for f in train_features], dtype=torch.long))
-                featurePositionDict["proc_ccs"] = positionIdx
-                positionIdx+=1
-            if "ndc"       in args.additional_features:
-                tensors.append(torch.tensor([f.ndc for f in train_features], dtype=torch.long))
-                featurePositionDict["ndc"] = positionIdx
-                positionIdx+=1
-
-        train_data = TensorDataset(*tensors)
 
         if args.local_rank == -1:
             train_sampler = RandomSampler(train_data)
         else:
             train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size, **loaderArgs)
         
-        optimizer = RangerOptimizer(params=optimizer_grouped_parameters,
-                                    lr=args.learning_rate,
-                                    # warmup_pct_default=args.warmup_proportion,
-                                    num_epochs=args.num_train_epochs,
-                                    num_batches_per_epoch=len(train_dataloader)
-                                   )
+        # The fused implementation updates all the parameters in a single CUDA kernel per step
+        optimizer = torch.optim.AdamW(optimizer_grouped_parameters,
+                                      lr=args.learning_rate,
+                                      weight_decay=0.01,
+                                      fused=device.type == "cuda")
+        # The master weights stay in fp32 on the device, only the forward runs in fp16 under autocast
+        scaler = torch.cuda.amp.GradScaler(enabled=args.fp16)
                                            
         model.train()
         for epo in trange(int(args.num_train_epochs), desc="Epoch"):
-            tr_loss = 0
+            # The step losses stay on the device and are copied back once per epoch, so no step waits on a sync
+            epoch_losses = []
             nb_tr_examples, nb_tr_steps = 0, 0
-            for step, batch in enumerate(tqdm(train_dataloader)):
-                # batch = tuple(t.to(device) for t in batch)
-                #
+            for step, batch in enumerate(tqdm(CUDAPrefetcher(train_dataloader, device))):
                 input_ids, input_mask, segment_ids, label_ids, *extraFeatures = batch
-                input_ids = input_ids.to(device)
-                input_mask = input_mask.to(device)
-                segment_ids = segment_ids.to(device)
-                label_ids = label_ids.to(device)
-                if extraFeatures:
-                    extraFeatures = [feature.to(device) for feature in extraFeatures]
-                    loss, logits = model(input_ids, segment_ids, input_mask, label_ids, additional_features_name=args.additional_features, additional_features_tensors=extraFeatures, feature_position_dict=featurePositionDict)
-                else:
-                    loss, logits = model(input_ids, segment_ids, input_mask, label_ids)
-
-                if n_gpu > 1:
-                    loss = loss.mean() # mean() to average on multi-gpu.
-                if args.fp16 and args.loss_scale != 1.0:
-                    # rescale loss for fp16 training
-                    # see https://docs.nvidia.com/deeplearning/sdk/mixed-precision-training/index.html
-                    loss = loss * args.loss_scale
+                with torch.cuda.amp.autocast(enabled=args.fp16):
+                    if extraFeatures:
+                        loss, logits = model(input_ids, segment_ids, input_mask, label_ids, additional_features_name=args.additional_features, additional_features_tensors=extraFeatures, feature_position_dict=featurePositionDict)
+                    else:
+                        loss, logits = model(input_ids, segment_ids, input_mask, label_ids)
+
                 if args.gradient_accumulation_steps > 1:
                     loss = loss / args.gradient_accumulation_steps
-                loss.backward()
-                train_loss_history.append(loss.item())
-                tr_loss += loss.item()
+                scaler.scale(loss).backward()
+                epoch_losses.append(loss.detach().float())
                 nb_tr_examples += input_ids.size(0)
                 nb_tr_steps += 1
                 if (step + 1) % args.gradient_accumulation_steps == 0:
-                    if args.fp16 or args.optimize_on_cpu:
-                        if args.fp16 and args.loss_scale != 1.0:
-                            # scale down gradients for fp16 training
-                            for param in model.parameters():
-                                if param.grad is not None:
-                                    param.grad.data = param.grad.data / args.loss_scale
-                        is_nan = set_optimizer_params_grad(param_optimizer, model.named_parameters(), test_nan=True)
-                        if is_nan:
-                            logger.info("FP16 TRAINING: Nan in gradients, reducing loss scaling")
-                            args.loss_scale = args.loss_scale / 2
-                            model.zero_grad()
-                            continue
-                        optimizer.step()
-                        copy_optimizer_params_to_model(model.named_parameters(), param_optimizer)
-                    else:
-                        optimizer.step()
-                    model.zero_grad()
+                    # GradScaler skips the step and lowers the loss scale when the gradients have inf/NaN
+                    scaler.step(optimizer)
+                    scaler.update()
+                    model.zero_grad(set_to_none=True)
                     global_step += 1
                 
                 # if (step+1) % 200 == 0:
@@ -426,118 +452,70 @@ def main():
 
             
             
+            epoch_losses = torch.stack(epoch_losses).tolist()
+            train_loss_history.extend(epoch_losses)
+            tr_loss = sum(epoch_losses)
             train_loss=tr_loss
             global_step_check=global_step
             number_training_steps=nb_tr_steps
             wandb.log({"Training loss": train_loss/number_training_steps})
             
-        string = os.path.join(args.output_dir, 'pytorch_model_new_'+args.readmission_mode+'.bin')
-        torch.save(model.state_dict(), string)
+        # Only the first process saves. The weights are copied to the host here and written by a background thread
+        # while the evaluation runs. The state_dict is taken from the module inside the DDP wrapper, without the "module." prefix
+        if args.local_rank in [-1, 0]:
+            string = os.path.join(args.output_dir, 'pytorch_model_new_'+args.readmission_mode+'.safetensors')
+            stateDict = {name: tensor.detach().contiguous().cpu() for name, tensor in getattr(model, "module", model).state_dict().items()}
+            saveThread = threading.Thread(target=save_file, args=(stateDict, string))
+            saveThread.start()
 
         fig1 = plt.figure()
         plt.plot(train_loss_history)
         fig_name = os.path.join(args.output_dir, 'loss_history.png')
         fig1.savefig(fig_name, dpi=fig1.dpi)
+
+        # Release the training set (and the persistent loader workers) before the evaluation set is built
+        del train_dataloader, train_sampler, train_data
+        gc.collect()
     
     m = nn.Sigmoid()
     if args.do_eval:
-        eval_examples = processor.get_test_examples(args.data_dir, args.additional_features)
-        eval_features = convert_examples_to_features(
-            eval_examples, label_list, args.max_seq_length, tokenizer, args.additional_features, maxLenDict)
+        eval_data, featurePositionDict = build_tensor_dataset(args, processor, "test", label_list, tokenizer, maxLenDict)
         logger.info("***** Running evaluation *****")
-        logger.info("  Num examples = %d", len(eval_examples))
+        logger.info("  Num examples = %d", len(eval_data))
         logger.info("  Batch size = %d", args.eval_batch_size)
-        all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.long)
-        tensors = [all_input_ids, all_input_mask, all_segment_ids, all_label_ids]
-
-        featurePositionDict = {}
-        positionIdx=0
-        # additionalFeatureOrder = [feature for feature in args.additional_features]
-        
-        if args.additional_features is not None:
-            if "admittime" in args.additional_features:
-                tensors.append(torch.tensor([f.admittime for f in eval_features], dtype=torch.long))
-                featurePositionDict["admittime"] = positionIdx
-                positionIdx+=1
-            if "daystonextadmit" in args.additional_features:
-                tensors.append(torch.tensor([f.daystonextadmit for f in eval_features], dtype=torch.long))
-                featurePositionDict["daystonextadmit"] = positionIdx
-                positionIdx+=1
-            if "duration"  in args.additional_features:
-                tensors.append(torch.tensor([f.duration for f in eval_features], dtype=torch.long))
-                featurePositionDict["duration"] = positionIdx
-                positionIdx+=1
-            if "diag_icd9" in args.additional_features:
-                tensors.append(torch.tensor([f.diag_icd9 for f in eval_features], dtype=torch.long))
-                featurePositionDict["diag_icd9"] = positionIdx
-                positionIdx+=1
-            if "diag_ccs"  in args.additional_features:
-                tensors.append(torch.tensor([f.diag_ccs for f in eval_features], dtype=torch.long))
-                featurePositionDict["diag_ccs"] = positionIdx
-                positionIdx+=1
-            if "proc_icd9" in args.additional_features:
-                tensors.append(torch.tensor([f.proc_icd9 for f in eval_features], dtype=torch.long))
-                featurePositionDict["proc_icd9"] = positionIdx
-                positionIdx+=1
-            if "proc_ccs"  in args.additional_features:
-                tensors.append(torch.tensor([f.proc_ccs for f in eval_features], dtype=torch.long))
-                featurePositionDict["proc_ccs"] = positionIdx
-                positionIdx+=1
-            if "ndc"       in args.additional_features:
-                tensors.append(torch.tensor([f.ndc for f in eval_features], dtype=torch.long))
-                featurePositionDict["ndc"] = positionIdx
-                positionIdx+=1
-
-        eval_data = TensorDataset(*tensors)
 
         if args.local_rank == -1:
             eval_sampler = SequentialSampler(eval_data)
         else:
             eval_sampler = DistributedSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size, **loaderArgs)
         model.eval()
         eval_loss, eval_accuracy = 0, 0
         nb_eval_steps, nb_eval_examples = 0, 0
+        # The per-batch results stay on the device and are copied back once after the loop
         true_labels=[]
-        pred_labels=[]
         logits_history=[]
 
-        for input_ids, input_mask, segment_ids, label_ids, *extraFeatures in tqdm(eval_dataloader):
-            input_ids = input_ids.to(device)
-            input_mask = input_mask.to(device)
-            segment_ids = segment_ids.to(device)
-            label_ids = label_ids.to(device)
-
-            with torch.no_grad():
+        for input_ids, input_mask, segment_ids, label_ids, *extraFeatures in tqdm(CUDAPrefetcher(eval_dataloader, device)):
+            with torch.no_grad(), torch.cuda.amp.autocast(enabled=args.fp16):
                 if extraFeatures:
-                    extraFeatures = [feature.to(device) for feature in extraFeatures]
-                    tmp_eval_loss, temp_logits = model(input_ids, segment_ids, input_mask, label_ids, additional_features_name=args.additional_features, additional_features_tensors=extraFeatures, feature_position_dict=featurePositionDict)
-                    logits = model(input_ids,segment_ids,input_mask, additional_features_name=args.additional_features, additional_features_tensors=extraFeatures, feature_position_dict=featurePositionDict)
+                    tmp_eval_loss, logits = model(input_ids, segment_ids, input_mask, label_ids, additional_features_name=args.additional_features, additional_features_tensors=extraFeatures, feature_position_dict=featurePositionDict)
                 else:
-                    tmp_eval_loss, temp_logits = model(input_ids, segment_ids, input_mask, label_ids)
-                    logits = model(input_ids, segment_ids, input_mask)
-            
-            logits = torch.squeeze(m(logits)).detach().cpu().numpy()
-            label_ids = label_ids.to('cpu').numpy()
-
-            outputs = np.asarray([1 if i else 0 for i in (logits.flatten()>=0.5)])
-            tmp_eval_accuracy=np.sum(outputs == label_ids)
+                    tmp_eval_loss, logits = model(input_ids, segment_ids, input_mask, label_ids)
             
-            true_labels = true_labels + label_ids.flatten().tolist()
-            pred_labels = pred_labels + outputs.flatten().tolist()
-            logits_history = logits_history + logits.flatten().tolist()
+            true_labels.append(label_ids.flatten())
+            logits_history.append(m(logits.float()).flatten())
        
-            eval_loss += tmp_eval_loss.mean().item()
-            eval_accuracy += tmp_eval_accuracy
+            eval_loss += tmp_eval_loss.mean().float()
 
             nb_eval_examples += input_ids.size(0)
             nb_eval_steps += 1
             
-        eval_loss = eval_loss / nb_eval_steps
-        eval_accuracy = eval_accuracy / nb_eval_examples
+        true_labels = torch.cat(true_labels).cpu().numpy()
+        logits_history = torch.cat(logits_history).cpu().numpy()
+        pred_labels = (logits_history >= 0.5).astype(np.int64)
+        eval_loss = eval_loss.item() / nb_eval_steps
+        eval_accuracy = np.sum(pred_labels == true_labels) / nb_eval_examples
         df = pd.DataFrame({'logits':logits_history, 'pred_label': pred_labels, 'label':true_labels})
         
         wandb.log({"Test loss": eval_loss, "Test accuracy": eval_accuracy})        